@@ -1,45 +1,71 @@
 #!/usr/bin/env python
 
+from __future__ import annotations
+
+import asyncio
+import atexit
+import collections
 import json
-import re
+import pathlib
+import queue
 import socket
+import string
 import sys
+import threading
 import time
 import tomllib
 import typing
 import uuid
 
 import logging
+import logging.handlers
 from abc import ABC, abstractmethod
 
 import paho.mqtt.client as paho
 
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(levelname)s: %(message)s",
     handlers=[
-        logging.StreamHandler(sys.stdout),
+        logging.handlers.QueueHandler(log_queue),
     ],
 )
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 try:
     from rpi_rf import RFDevice
 except Exception as importExc:
-    logging.warning("Can't import RFDevice, actions won't work:", exc_info=importExc)
+    logging.warning("Can't import RFDevice, actions won't work", exc_info=importExc)
+    RFDevice = None
 
 
 class MqttEntity(ABC):
+    __slots__ = ("name", "icon", "state_topic", "command_topic", "discovery_topic", "unique_id", "device",
+                 "discovery_payload", "last_published")
+
     def __init__(self, entity_id: str, name: str, icon: str, component: str):
         self.name = name
         self.icon = icon
-        self.state_topic = f'{config["mqtt"]["topic_prefix"]}/{hostname}/{entity_id}'
-        self.command_topic = f'{config["mqtt"]["topic_prefix"]}/{hostname}/{entity_id}/set'
-        self.discovery_topic = f'{config["ha"]["discovery_prefix"]}/{component}/{hostname}/{entity_id}/config'
+        self.state_topic = sys.intern(f'{topic_prefix}/{hostname}/{entity_id}')
+        self.command_topic = sys.intern(f'{topic_prefix}/{hostname}/{entity_id}/set')
+        self.discovery_topic = sys.intern(f'{discovery_prefix}/{component}/{hostname}/{entity_id}/config')
         self.unique_id = f'{hostname}_{entity_id}'
-        self.device = build_device_info()
+        self.device = device_info
+        self.discovery_payload = None
+        self.last_published = {}
 
     def __str__(self):
-        return str(vars(self))
+        slots = (slot for cls in reversed(type(self).__mro__) for slot in getattr(cls, "__slots__", ()))
+        return str({slot: getattr(self, slot, None) for slot in slots})
 
     def build_discovery(self) -> dict[str, typing.Any]:
         return {
@@ -51,14 +77,29 @@ class MqttEntity(ABC):
 
     def initial_publish(self, client: paho.Client):
         if self.discovery_topic is not None:
-            client.publish(self.discovery_topic, json.dumps(self.build_discovery()))
-
-    def subscribe(self, client: paho.Client):
+            client.publish(self.discovery_topic, self.discovery_payload, qos=mqtt_qos, retain=True)
+
+    def publish_if_changed(self, client: paho.Client, topic: str, payload, retain: bool = True):
+        if self.last_published.get(topic) == payload:
+            return
+        self.last_published[topic] = payload
+        # retained and resent after a reconnect (last_published is cleared), QoS 0 is enough
+        client.publish(topic, payload, qos=0, retain=retain)
+        if retain:
+            # paho publishes numbers as strings
+            retained_publishes[topic] = payload if isinstance(payload, bytes) else str(payload).encode()
+
+    def publish_multi(self, client: paho.Client, items: typing.Iterable[tuple[str, typing.Any]], retain: bool = True):
+        for topic, payload in items:
+            self.publish_if_changed(client, topic, payload, retain=retain)
+
+    def topics(self) -> list[tuple[str, int]]:
         if self.command_topic is not None:
-            client.subscribe(self.command_topic)
+            return [(self.command_topic, mqtt_qos)]
+        return []
 
     @abstractmethod
-    def handle_message(self, client: paho.Client, topic: str, payload):
+    def register_handlers(self, handlers: dict[str, typing.Callable[[paho.Client, bytes], None]]):
         pass
 
 
@@ -67,6 +108,8 @@ class Button(MqttEntity):
     https://www.home-assistant.io/integrations/button.mqtt/
     """
 
+    __slots__ = ("rf_code", "rf_protocol", "rf_pulse_length", "rf_repeat", "last_press")
+
     def __init__(self, entity_id: str, name: str, icon: str, rf_code: int, rf_protocol: int = 1,
                  rf_pulse_length: int = None,
                  rf_repeat: int = None):
@@ -75,16 +118,23 @@ class Button(MqttEntity):
         self.rf_protocol = rf_protocol
         self.rf_pulse_length = rf_pulse_length
         self.rf_repeat = rf_repeat
+        self.last_press = None
 
     def build_discovery(self) -> dict[str, typing.Any]:
         return super().build_discovery() | {
             "command_topic": self.command_topic,
         }
 
-    def handle_message(self, client: paho.Client, topic: str, payload):
-        if topic == self.command_topic:
-            if payload == "PRESS":
-                self.send_action(self.rf_code)
+    def register_handlers(self, handlers: dict[str, typing.Callable[[paho.Client, bytes], None]]):
+        handlers[self.command_topic] = self.handle_command
+
+    def handle_command(self, client: paho.Client, payload: bytes):
+        if payload == b"PRESS":
+            now = time.monotonic()
+            if self.last_press is not None and now - self.last_press < button_debounce:
+                return
+            self.last_press = now
+            self.send_action(self.rf_code)
 
     def send_action(self, rf_code: int):
         send_code(rf_code, self.rf_protocol, self.rf_pulse_length, self.rf_repeat)
@@ -95,11 +145,14 @@ class Switch(MqttEntity):
     https://www.home-assistant.io/integrations/switch.mqtt/
     """
 
+    __slots__ = ("rf_code_on", "rf_code_off", "rf_codes", "rf_protocol", "rf_pulse_length", "rf_repeat")
+
     def __init__(self, entity_id: str, name: str, icon: str, rf_code_on: int, rf_code_off: int, rf_protocol: int = 1,
                  rf_pulse_length: int = None, rf_repeat: int = None):
         super().__init__(entity_id, name, icon, "switch")
         self.rf_code_on = rf_code_on
         self.rf_code_off = rf_code_off
+        self.rf_codes = {b"ON": rf_code_on, b"OFF": rf_code_off}
         self.rf_protocol = rf_protocol
         self.rf_pulse_length = rf_pulse_length
         self.rf_repeat = rf_repeat
@@ -110,14 +163,13 @@ class Switch(MqttEntity):
             "command_topic": self.command_topic,
         }
 
-    def handle_message(self, client: paho.Client, topic: str, payload):
-        if topic == self.command_topic:
-            if payload == "ON":
-                self.send_action(self.rf_code_on)
-                client.publish(self.state_topic, payload, retain=True)
-            elif payload == "OFF":
-                self.send_action(self.rf_code_off)
-                client.publish(self.state_topic, payload, retain=True)
+    def register_handlers(self, handlers: dict[str, typing.Callable[[paho.Client, bytes], None]]):
+        handlers[self.command_topic] = self.handle_command
+
+    def handle_command(self, client: paho.Client, payload: bytes):
+        if payload in self.rf_codes:
+            self.send_action(self.rf_codes[payload])
+            self.publish_if_changed(client, self.state_topic, payload)
 
     def send_action(self, rf_code: int):
         send_code(rf_code, self.rf_protocol, self.rf_pulse_length, self.rf_repeat)
@@ -128,6 +180,10 @@ class LightSwitch(MqttEntity):
     https://www.home-assistant.io/integrations/light.mqtt/
     """
 
+    __slots__ = ("state", "brightness_state", "rf_code_on", "rf_code_off", "rf_protocol", "rf_pulse_length",
+                 "rf_repeat", "brightness_state_topic", "brightness_command_topic", "brightness_codes", "effects",
+                 "effect_codes", "effect_state_topic", "effect_command_topic")
+
     def __init__(self, entity_id: str, name: str, icon: str, rf_code_on: int, rf_code_off: int,
                  brightness_codes: list[int] = None, effects: dict[str, int] = None,
                  rf_protocol: int = 1, rf_pulse_length: int = None, rf_repeat: int = None):
@@ -141,14 +197,15 @@ class LightSwitch(MqttEntity):
         self.rf_pulse_length = rf_pulse_length
         self.rf_repeat = rf_repeat
 
-        self.brightness_state_topic = self.state_topic + "/brightness"
-        self.brightness_command_topic = self.brightness_state_topic + "/set"
-        self.brightness_codes = brightness_codes
+        self.brightness_state_topic = sys.intern(f'{self.state_topic}/brightness')
+        self.brightness_command_topic = sys.intern(f'{self.state_topic}/brightness/set')
+        self.brightness_codes = tuple(brightness_codes) if brightness_codes is not None else None
         if effects is not None and len(effects) > 0:
             effects.update({"Off": -1})
             self.effects = effects
-            self.effect_state_topic = self.state_topic + "/effect"
-            self.effect_command_topic = self.effect_state_topic + "/set"
+            self.effect_codes = {effect.encode(): rf_code for effect, rf_code in effects.items()}
+            self.effect_state_topic = sys.intern(f'{self.state_topic}/effect')
+            self.effect_command_topic = sys.intern(f'{self.state_topic}/effect/set')
 
     def build_discovery(self) -> dict[str, typing.Any]:
         return super().build_discovery() | {
@@ -162,71 +219,128 @@ class LightSwitch(MqttEntity):
             "effect_command_topic": self.effect_command_topic,
         }
 
-    def subscribe(self, client: paho.Client):
-        super().subscribe(client)
-        client.subscribe(self.state_topic)
-        client.subscribe(self.brightness_state_topic)
-        client.subscribe(self.brightness_command_topic)
-        client.subscribe(self.effect_command_topic)
-
-    def handle_message(self, client: paho.Client, topic: str, payload):
-        if topic == self.state_topic:
-            self.state = payload
-        if topic == self.brightness_state_topic:
-            self.brightness_state = int(payload)
-
-        if topic == self.command_topic:
-            if payload == "ON":
-                self.send_action(self.rf_code_on)
-                if self.state == "OFF" and self.brightness_state is not None:
-                    self.send_brightness(self.brightness_state)
-                client.publish(self.state_topic, payload, retain=True)
-
-            elif payload == "OFF":
-                self.send_action(self.rf_code_off)
-                client.publish(self.state_topic, payload, retain=True)
-
-        if topic == self.brightness_command_topic:
-            if self.state != "ON":
-                self.state = "ON"  # otherwise there is a race-condition between publishing and receiving as HA first sends a brightness command THEN a state command
-                self.send_action(self.rf_code_on)
-                client.publish(self.state_topic, "ON", retain=True)
-            brightness = int(payload)
-            self.set_brightness(client, brightness)
-
-        if topic == self.effect_command_topic:
-            if payload == "Off":
-                self.set_brightness(client, self.brightness_state or 1)
-                client.publish(self.effect_state_topic, "OFF", retain=True)
-                return
-
-            rf_code = self.effects[payload]
-            if rf_code is not None:
-                self.send_action(rf_code)
-                client.publish(self.effect_state_topic, payload, retain=True)
-
-    def send_brightness(self, brightness: int) -> bool:
-        brightness -= 1
-        if len(self.brightness_codes) > brightness >= 0:
-            rf_code = self.brightness_codes[brightness]
+    def topics(self) -> list[tuple[str, int]]:
+        return super().topics() + [
+            (self.state_topic, 0),
+            (self.brightness_state_topic, 0),
+            (self.brightness_command_topic, mqtt_qos),
+            (self.effect_command_topic, mqtt_qos),
+        ]
+
+    def register_handlers(self, handlers: dict[str, typing.Callable[[paho.Client, bytes], None]]):
+        handlers[self.state_topic] = self.handle_state
+        handlers[self.brightness_state_topic] = self.handle_brightness_state
+        handlers[self.command_topic] = self.handle_command
+        handlers[self.brightness_command_topic] = self.handle_brightness_command
+        handlers[self.effect_command_topic] = self.handle_effect_command
+
+    def handle_state(self, client: paho.Client, payload: bytes):
+        self.state = payload
+        self.last_published[self.state_topic] = payload
+
+    def handle_brightness_state(self, client: paho.Client, payload: bytes):
+        self.brightness_state = int(payload)
+        self.last_published[self.brightness_state_topic] = self.brightness_state
+
+    def handle_command(self, client: paho.Client, payload: bytes):
+        if payload == b"ON":
+            rf_codes = [self.rf_code_on]
+            items = [(self.state_topic, payload)]
+            if self.state == b"OFF" and self.brightness_state is not None:
+                brightness_code = self.get_brightness_code(self.brightness_state)
+                if brightness_code is not None:
+                    rf_codes.append(brightness_code)
+                    items += self.brightness_items(self.brightness_state)
+            self.send_actions(rf_codes)
+            self.publish_multi(client, items)
+
+        elif payload == b"OFF":
+            self.send_action(self.rf_code_off)
+            self.publish_if_changed(client, self.state_topic, payload)
+            # the shown effect is unknown after switching it on again
+            self.last_published.pop(self.effect_state_topic, None)
+
+    def handle_brightness_command(self, client: paho.Client, payload: bytes):
+        brightness = int(payload)
+        if (self.state == b"ON" and brightness == self.brightness_state
+                and self.last_published.get(self.effect_state_topic) == b"OFF"):
+            return
+        brightness_code = self.get_brightness_code(brightness)
+
+        if self.state != b"ON":
+            self.send_action(self.rf_code_on)
+        if brightness_code is not None:
+            self.send_brightness_action(brightness_code)
+
+        items = []
+        if self.state != b"ON":
+            self.state = b"ON"  # otherwise there is a race-condition between publishing and receiving as HA first sends a brightness command THEN a state command
+            items.append((self.state_topic, b"ON"))
+        if brightness_code is not None:
+            items += self.brightness_items(brightness)
+        self.publish_multi(client, items)
+
+    def handle_effect_command(self, client: paho.Client, payload: bytes):
+        if payload == b"Off":
+            self.set_brightness(client, self.brightness_state or 1)
+            self.publish_if_changed(client, self.effect_state_topic, b"OFF")
+            return
+
+        if self.state == b"ON" and self.last_published.get(self.effect_state_topic) == payload:
+            return
+        rf_code = self.effect_codes.get(payload)
+        if rf_code is not None:
             self.send_action(rf_code)
-            return True
-        return False
+            self.publish_if_changed(client, self.effect_state_topic, payload)
+
+    def get_brightness_code(self, brightness: int) -> int | None:
+        if 1 <= brightness <= len(self.brightness_codes):
+            return self.brightness_codes[brightness - 1]
+        return None
 
     def set_brightness(self, client: paho.Client, brightness: int):
-        success = self.send_brightness(brightness)
-        if success:
-            client.publish(self.brightness_state_topic, brightness, retain=True)
-            client.publish(self.effect_state_topic, "OFF", retain=True)
+        rf_code = self.get_brightness_code(brightness)
+        if rf_code is not None:
+            self.send_brightness_action(rf_code)
+            self.publish_brightness(client, brightness)
+
+    def publish_brightness(self, client: paho.Client, brightness: int):
+        self.publish_multi(client, self.brightness_items(brightness))
+
+    def brightness_items(self, brightness: int) -> list[tuple[str, typing.Any]]:
+        return [(self.brightness_state_topic, brightness), (self.effect_state_topic, b"OFF")]
 
     def send_action(self, rf_code: int):
         send_code(rf_code, self.rf_protocol, self.rf_pulse_length, self.rf_repeat)
 
+    def send_actions(self, rf_codes: list[int]):
+        send_codes(rf_codes, self.rf_protocol, self.rf_pulse_length, self.rf_repeat)
+
+    def send_brightness_action(self, rf_code: int):
+        send_code(rf_code, self.rf_protocol, self.rf_pulse_length, self.rf_repeat,
+                  coalesce_key=self.brightness_command_topic)
+
+
+SANITIZE_TABLE = bytes(c if chr(c) in string.ascii_letters + string.digits + "_-" else ord("_") for c in range(256))
+
+
+def sanitize_name(name: str) -> str:
+    # non-ASCII characters become "?"
+    return name.encode("ascii", "replace").translate(SANITIZE_TABLE).decode("ascii")
+
 
 def get_mac_address():
+    # physical interfaces have a "device" link
+    for interface in sorted(pathlib.Path("/sys/class/net").glob("*/device")):
+        try:
+            mac = (interface.parent / "address").read_text().strip()
+        except OSError:
+            continue
+        if mac and mac != "00:00:00:00:00:00":
+            return mac.replace(":", "-").upper()
+
     mac_num = uuid.getnode()
-    mac = '-'.join((('%012X' % mac_num)[i:i + 2] for i in range(0, 12, 2)))
-    return mac
+    return mac_num.to_bytes(6, "big").hex("-").upper()
 
 
 def build_device_info():
@@ -237,28 +351,102 @@ def build_device_info():
     }
 
 
-def send_code(rf_code, rf_protocol: int = 1, rf_pulse_length: int = None, rf_repeat: int = None):
-    rf_device = None
-    try:
-        if rf_repeat is None:
-            rf_repeat = default_rf_repeat
-
-        # Configure the RF transmitter
-        rf_device = RFDevice(rf_gpio_pin)
-        rf_device.enable_tx()
-        rf_device.tx_repeat = rf_repeat
-
-        # Send the code
-        logging.info("Sending code: %s with protocol: %s, pulse_length: %s, repetitions: %s", rf_code, rf_protocol,
-                     rf_pulse_length, rf_repeat)
-        success = rf_device.tx_code(rf_code, rf_protocol, tx_pulselength=rf_pulse_length)
-        if not success:
-            logging.error("Failed to send code")
-    except NameError as e:
-        logging.error("Unable to send code: 'RFDevice' not accessible", exc_info=e)
-    finally:
+def open_rf_device():
+    # Configure the RF transmitter
+    device = RFDevice(rf_gpio_pin)
+    device.enable_tx()
+    return device
+
+
+def close_rf_device():
+    with rf_lock:
         if rf_device is not None:
-            rf_device.cleanup()
+            release_rf_device()
+
+
+def release_rf_device():
+    global rf_device
+
+    # the caller holds rf_lock
+    try:
+        rf_device.cleanup()
+    except Exception as e:
+        logging.error("Unable to release RF transmitter", exc_info=e)
+    rf_device = None
+
+
+def send_code(rf_code, rf_protocol: int = 1, rf_pulse_length: int = None, rf_repeat: int = None,
+              coalesce_key: str = None):
+    send_codes([rf_code], rf_protocol, rf_pulse_length, rf_repeat, coalesce_key)
+
+
+def send_codes(rf_codes: list[int], rf_protocol: int = 1, rf_pulse_length: int = None, rf_repeat: int = None,
+               coalesce_key: str = None):
+    if len(rf_codes) == 0:
+        return
+    if RFDevice is None:
+        logging.error("Unable to send code: %s, 'RFDevice' not accessible", rf_codes)
+        return
+
+    job = (tuple(rf_codes), rf_protocol, rf_pulse_length, rf_repeat, coalesce_key)
+    with tx_condition:
+        if len(tx_queue) > 0 and tx_queue[-1] == job:
+            logging.info("Skipping code: %s, already queued", job[0])
+            return
+        if coalesce_key is not None and len(tx_queue) > 0 and tx_queue[-1][4] == coalesce_key:
+            # replacing earlier jobs would reorder them
+            logging.info("Replacing queued code: %s with: %s", tx_queue[-1][0], job[0])
+            tx_queue[-1] = job
+            return
+        if len(tx_queue) == tx_queue.maxlen:
+            # the deque drops the oldest job
+            logging.warning("Dropping code: %s, too many codes queued", tx_queue[0][0])
+        tx_queue.append(job)
+        tx_condition.notify()
+
+
+def tx_worker():
+    while True:
+        with tx_condition:
+            while len(tx_queue) == 0:
+                tx_condition.wait()
+            rf_codes, rf_protocol, rf_pulse_length, rf_repeat, _ = tx_queue.popleft()
+        try:
+            transmit_codes(rf_codes, rf_protocol, rf_pulse_length, rf_repeat)
+        except Exception as e:
+            logging.error("Unable to send code: %s", rf_codes, exc_info=e)
+
+
+def transmit_codes(rf_codes: typing.Sequence[int], rf_protocol: int = 1, rf_pulse_length: int = None,
+                   rf_repeat: int = None):
+    global rf_device, rf_default_pulse_length
+
+    if rf_repeat is None:
+        rf_repeat = default_rf_repeat
+
+    # Send the codes back-to-back
+    with rf_lock:
+        if rf_device is None:
+            try:
+                rf_device = open_rf_device()
+            except (OSError, RuntimeError) as e:
+                logging.error("Unable to send code: RF transmitter not available", exc_info=e)
+                return
+            rf_default_pulse_length = rf_device.tx_pulselength
+
+        try:
+            rf_device.tx_repeat = rf_repeat
+            for rf_code in rf_codes:
+                # tx_code would keep the previous pulse length
+                rf_device.tx_pulselength = rf_default_pulse_length
+                logging.info("Sending code: %s with protocol: %s, pulse_length: %s, repetitions: %s", rf_code,
+                             rf_protocol, rf_pulse_length, rf_repeat)
+                success = rf_device.tx_code(rf_code, rf_protocol, tx_pulselength=rf_pulse_length)
+                if not success:
+                    logging.error("Failed to send code")
+        except Exception as e:
+            logging.error("Unable to send code: RF transmitter failed", exc_info=e)
+            release_rf_device()
 
 
 def create_entities(config_entities):
@@ -302,41 +490,127 @@ def create_entities(config_entities):
                     ))
                 case _:
                     logging.info("%s: Invalid entity type: %s", key, value.get("type"))
+
+    for entity in configured_entities:
+        entity.discovery_payload = json.dumps(entity.build_discovery()).encode()
     return configured_entities
 
 
-def on_message(client: paho.Client, userdata, msg: paho.MQTTMessage):
-    payload = msg.payload.decode()
-    logging.info("MQTT: Received message: %s %s, retain=%s", msg.topic, payload, msg.retain)
+def create_topic_handlers(configured_entities):
+    handlers = {}
+    for entity in configured_entities:
+        entity.register_handlers(handlers)
+    if birth_topic is not None and birth_payload is not None:
+        handlers[birth_topic] = handle_birth
+    return handlers
 
-    if config["ha"]["birth_topic"] is not None:
-        if msg.topic == config["ha"]["birth_topic"] and payload == config["ha"]["birth_payload"]:
-            # TODO add a randomized delay
-            publish_entity_discovery_messages(client)
 
-    for entity in entities:
-        entity.handle_message(client, msg.topic, payload)
+def handle_birth(client: paho.Client, payload: bytes):
+    if payload == birth_payload:
+        # TODO add a randomized delay
+        publish_entity_discovery_messages(client)
+
+
+def on_message(client: paho.Client, userdata, msg: paho.MQTTMessage):
+    topic = msg.topic
+    payload = msg.payload
+    logging.info("MQTT: Received message: %s %s, retain=%s", topic, payload.decode(errors="replace"), msg.retain)
+
+    if msg.retain and discovery_check_handle is not None and paho.topic_matches_sub(discovery_subscription, topic):
+        retained_discovery_payloads[topic] = payload
+        return
+    last_retained = retained_publishes.get(topic)
+    if last_retained is not None:
+        if last_retained == payload:
+            if msg.retain:
+                # replay of our own latest state
+                return
+        else:
+            # changed by someone else
+            del retained_publishes[topic]
+
+    handler = topic_handlers.get(topic)
+    if handler is not None:
+        try:
+            handler(client, payload)
+        except Exception as e:
+            # paho would otherwise get stuck on the packet
+            logging.error("MQTT: Unable to handle message: %s %s", topic, payload.decode(errors="replace"),
+                          exc_info=e)
 
 
 def publish_entity_discovery_messages(client: paho.Client):
+    global discovery_check_handle
+
+    if len(discovery_topics) == 0:
+        return
+
+    if discovery_check_handle is not None:
+        discovery_check_handle.cancel()
+    retained_discovery_payloads.clear()
+    client.subscribe(discovery_subscription)
+    discovery_check_handle = asyncio.get_running_loop().call_later(discovery_check_timeout,
+                                                                   publish_changed_discovery_messages, client)
+
+
+def publish_changed_discovery_messages(client: paho.Client):
+    global discovery_check_handle
+
+    discovery_check_handle = None
+    client.unsubscribe(discovery_subscription)
+
+    published = 0
     for entity in entities:
-        entity.initial_publish(client)
-    logging.info("MQTT: Published discovery messages")
+        if retained_discovery_payloads.get(entity.discovery_topic) != entity.discovery_payload:
+            entity.initial_publish(client)
+            published += 1
+
+    # entities removed from the config
+    removed = 0
+    for topic, payload in retained_discovery_payloads.items():
+        if topic not in discovery_topics and is_own_discovery_payload(payload):
+            client.publish(topic, b"", qos=mqtt_qos, retain=True)
+            removed += 1
+    retained_discovery_payloads.clear()
+    logging.info("MQTT: Published %s of %s discovery messages", published, len(entities))
+    if removed > 0:
+        logging.info("MQTT: Removed %s discovery messages of unconfigured entities", removed)
+
+
+def is_own_discovery_payload(payload: bytes) -> bool:
+    try:
+        discovery = json.loads(payload)
+    except ValueError:
+        return False
+    return isinstance(discovery, dict) and discovery.get("device") == device_info
+
+
+def subscribe_all(client: paho.Client, configured_entities):
+    topics = [topic for entity in configured_entities for topic in entity.topics()]
+    if birth_topic is not None and birth_payload is not None:
+        topics.append((birth_topic, 0))
+    if len(topics) > 0:
+        client.subscribe(topics)
 
 
 def on_connect(client: paho.Client, userdata, flags: paho.ConnectFlags, reason_code: paho.ReasonCode,
                properties: paho.Properties):
+    global reconnect_delay
+
     if reason_code != 0:
         logging.error("MQTT: Unable to connect to broker, reason code: %s", reason_code)
     else:
         logging.info("MQTT: Connected to broker")
-        if config["ha"]["birth_topic"] is not None and config["ha"]["birth_payload"] is not None:
-            client.subscribe(config["ha"]["birth_topic"])
-        else:
-            publish_entity_discovery_messages(client)
-
+        reconnect_delay = reconnect_min_delay
+        # the broker might have lost the retained states
         for entity in entities:
-            entity.subscribe(client)
+            entity.last_published.clear()
+
+        # before announcing the entities
+        subscribe_all(client, entities)
+
+        if birth_topic is None or birth_payload is None:
+            publish_entity_discovery_messages(client)
 
 
 def on_disconnect(client: paho.Client, userdata, flags: paho.DisconnectFlags, reason_code: paho.ReasonCode,
@@ -347,9 +621,49 @@ def on_disconnect(client: paho.Client, userdata, flags: paho.DisconnectFlags, re
         logging.info("MQTT: Disconnected from broker")
 
 
-def on_log(client: paho.Client, userdata, level: int, msg: str):
-    if level == paho.MQTT_LOG_DEBUG and "Connection" in msg:
-        logging.info("MQTT: %s", msg)
+class AsyncioHelper:
+    """
+    Drives the paho client from an asyncio event loop through its socket callbacks.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: paho.Client):
+        self.loop = loop
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client: paho.Client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client: paho.Client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def on_socket_register_write(self, client: paho.Client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client: paho.Client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+
+async def run_client(client: paho.Client, host: str, port: int):
+    global reconnect_delay
+
+    AsyncioHelper(asyncio.get_running_loop(), client)
+
+    while True:
+        try:
+            client.connect(host, port)
+        except OSError as e:
+            logging.error("MQTT: Unable to connect to broker: %s", e)
+        else:
+            while client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+
+        # reset in on_connect
+        await asyncio.sleep(reconnect_delay)
+        reconnect_delay = min(reconnect_delay * 2, reconnect_max_delay)
 
 
 if __name__ == '__main__':
@@ -357,31 +671,64 @@ if __name__ == '__main__':
         config = tomllib.load(f)
 
     device_name = config["ha"].get("device_name") if isinstance(config["ha"], dict) else None
-    hostname = re.sub(r'[^a-zA-Z0-9_-]', '_', device_name or socket.gethostname())
+    hostname = sanitize_name(device_name or socket.gethostname())
+    device_info = build_device_info()
+
+    topic_prefix = config["mqtt"]["topic_prefix"]
+    mqtt_qos = int(config["mqtt"].get("qos", 0))
+    discovery_prefix = config["ha"]["discovery_prefix"]
+    discovery_subscription = f'{discovery_prefix}/+/{hostname}/+/config'
+    birth_topic = config["ha"].get("birth_topic") if isinstance(config["ha"], dict) else None
+    birth_payload = config["ha"].get("birth_payload") if isinstance(config["ha"], dict) else None
+    if birth_topic is not None:
+        birth_topic = sys.intern(birth_topic)
+    if birth_payload is not None:
+        birth_payload = birth_payload.encode()
 
     rf_gpio_pin = config["rf"].get("gpio_pin", 17) if isinstance(config["rf"], dict) else None
     default_rf_protocol = config["rf"].get("protocol", 1) if isinstance(config["rf"], dict) else None
     default_rf_repeat = config["rf"].get("repeat", 10) if isinstance(config["rf"], dict) else None
+    rf_device = None  # opened on first use
+    rf_default_pulse_length = None
+    rf_lock = threading.Lock()
+    atexit.register(close_rf_device)
+
+    tx_queue = collections.deque(maxlen=8)
+    tx_condition = threading.Condition()
+    threading.Thread(target=tx_worker, name="rf-tx", daemon=True).start()
+
+    reconnect_min_delay = 1
+    reconnect_max_delay = 120
+    reconnect_delay = reconnect_min_delay
+    discovery_check_timeout = 1
+    button_debounce = 0.05
 
     if len(config) == 0 or config.get("entities") is None or len(config.get("entities")) == 0:
         logging.error("No entities defined in config")
         exit(1)
 
     entities = create_entities(config.get("entities"))
-
-    client = paho.Client(paho.CallbackAPIVersion.VERSION2,
-                         client_id=config["mqtt"]["topic_prefix"] + "-" + hostname + "_" + str(int(time.time())))
+    discovery_topics = {entity.discovery_topic for entity in entities if entity.discovery_topic is not None}
+    retained_discovery_payloads = {}
+    discovery_check_handle = None
+    retained_publishes = {}
+    topic_handlers = create_topic_handlers(entities)
+
+    # the broker keeps the session across restarts
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=f'{topic_prefix}-{hostname}',
+                         clean_session=False)
     client.enable_logger(logging.root)
     client.username_pw_set(config["mqtt"]["user"], config["mqtt"]["password"])
-    client.on_log = on_log
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
     # client.will_set(config["mqtt"]["topic_prefix"] + "/" + hostname + "/status", "0",
     #                 qos=config.qos, retain=config.retain)
-    client.connect_async(config["mqtt"]["host"], int(config["mqtt"]["port"]))
 
     try:
-        client.loop_forever(retry_first_connection=True)
+        if uvloop is not None:
+            uvloop.run(run_client(client, config["mqtt"]["host"], int(config["mqtt"]["port"])))
+        else:
+            asyncio.run(run_client(client, config["mqtt"]["host"], int(config["mqtt"]["port"])))
     except KeyboardInterrupt:
         logging.info("Exiting...")